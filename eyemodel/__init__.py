@@ -5,27 +5,38 @@ import sys
 import os
 import math
 import collections
+import copy
 import subprocess
 import tempfile
 import shutil
 import time
 import traceback
-import threading
+import concurrent.futures
 import re
 import random
 import signal
 import struct
-try:
-    from Queue import Queue, Empty
-except ImportError:
-    from queue import Queue, Empty  # python 3.x
+import errno
+import json
+from queue import Queue
 
-SCRIPT_PATH = sys.arg[0] if __name__ == "__main__" else __file__
+SCRIPT_PATH = sys.argv[0] if __name__ == "__main__" else __file__
 SCRIPT_DIR = os.path.dirname(SCRIPT_PATH)
 
 MODEL_PATH = os.path.join(SCRIPT_DIR, "Swirski-EyeModel.blend")
 TEXTURE_PATH = os.path.join(SCRIPT_DIR, "textures")
-BLENDER_SCRIPT_TEMPLATE = os.path.join(SCRIPT_DIR, "blender_script.py.template")
+BLENDER_DRIVER_SCRIPT = os.path.join(SCRIPT_DIR, "blender_driver.py")
+BLENDER_WORKER_SCRIPT = os.path.join(SCRIPT_DIR, "blender_worker.py")
+
+def _find_irises():
+    return {f[len("ireye-"):-len(".png")] for f in os.listdir(TEXTURE_PATH)
+            if f.startswith("ireye-") and f.endswith(".png")}
+
+# Iris names with an ireye-<name>.png texture
+_AVAILABLE_IRISES = _find_irises()
+
+# Printed by the worker script, followed by an exit status, when a command finishes
+WORKER_SENTINEL = "EYEMODEL_WORKER_DONE"
 
 RENDER_LINE_RE = re.compile(r"""
     Fra: \s* (?P<frame>\d+) \s*                     # Frame number
@@ -51,6 +62,16 @@ RENDER_LINE_RE = re.compile(r"""
 """, flags=re.VERBOSE)
 
 
+def _user_cache_dir():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/AppData/Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "eyemodel")
+
+
 def get_blender_path():
     def isexecutable(path):
         return os.path.isfile(path) and os.access(path, os.X_OK)
@@ -92,9 +113,92 @@ def check_blender_version():
         print("Unable to determine Blender version. Please ensure Blender is installed correctly.")
 
 
-class Light(collections.namedtuple('Light', ["location", "target", "type", "size", "strength", "view_angle"])):
-    def __new__(cls, location, target, type="spot", size=2, strength=2, view_angle=45):
-        return super(Light, cls).__new__(cls, location, target, type, size, strength, view_angle)
+def _start_blender(blender_args, stderr, **kwargs):
+    # Only stdout is piped, stderr goes straight to the log (or wherever it's sent)
+    if hasattr(os.sys, 'winver'):
+        return subprocess.Popen(blender_args, bufsize=8192, stdout=subprocess.PIPE, stderr=stderr, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP, **kwargs)
+    else:
+        return subprocess.Popen(blender_args, bufsize=8192, stdout=subprocess.PIPE, stderr=stderr, **kwargs)
+
+def _kill_blender(p):
+    print("Killing blender")
+    if hasattr(os.sys, 'winver'):
+        os.kill(p.pid, signal.CTRL_BREAK_EVENT)
+    else:
+        p.send_signal(signal.SIGKILL)
+    p.wait()
+    print("Blender killed")
+
+def _read_lines(p):
+    # Yields lines of blender's stdout until it closes
+    for line in iter(p.stdout.readline, b''):
+        yield line.rstrip().decode("utf-8")
+    p.stdout.close()
+
+def _process_output(lines, blender_err_file_name, sentinel=None):
+    # Prints render progress and logs every line. Returns the status following the
+    # sentinel, or None if blender's output ended first.
+    for line in lines:
+        if sentinel is not None and line.startswith(sentinel):
+            return int(line[len(sentinel):])
+
+        # Cheap prefix check first, most lines aren't progress lines
+        m = line.startswith("Fra:") and RENDER_LINE_RE.match(line)
+        if m:
+            tile = int(m.group("tile"))
+            tiles = int(m.group("tiles"))
+            sample = int(m.group("sample"))
+            samples = int(m.group("samples"))
+            print("Rendered {percent}%, time remaining: {rem} (tile {tile}/{tiles}, sample {sample}/{samples})".format(
+                percent=100 * ((tile-1)*samples + (sample-1)) / (tiles*samples),
+                **m.groupdict()
+            ))
+
+        with open(blender_err_file_name, "a") as blender_err_file:
+            blender_err_file.write("out | ")
+            blender_err_file.write(line)
+            blender_err_file.write("\n")
+    return None
+
+
+class _BlenderWorker():
+    """Background blender process which is kept alive between renders.
+
+    Each command names a generated scene script for the worker to run, and the
+    worker reports back with a sentinel line on stdout once it is done.
+    """
+
+    def __init__(self, blender_path, env=None):
+        self.args = [blender_path,
+                     MODEL_PATH,                                # Load model
+                     "--background",                            # Load the file in the background (no UI)
+                     "--enable-autoexec",                       # Automatic python script execution
+                     "--verbose", "0",                          # No debug output
+                     "-noaudio",                                # Don't use audio
+                     "--python", BLENDER_WORKER_SCRIPT,         # Read commands from stdin until it is closed
+                     "--", WORKER_SENTINEL]
+        # Until the first command, stderr goes to ours
+        self.process = _start_blender(self.args, None, stdin=subprocess.PIPE, env=env)
+        self.lines = _read_lines(self.process)
+        print("Started blender worker")
+
+    def send(self, command):
+        self.process.stdin.write((json.dumps(command) + "\n").encode("utf-8"))
+        self.process.stdin.flush()
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                _kill_blender(self.process)
+        print("Stopped blender worker")
+
+
+class Light(collections.namedtuple('Light', ["location", "target", "type", "size", "strength", "view_angle"],
+                                   defaults=["spot", 2, 2, 45])):
+    __slots__ = ()
 
 
 class Renderer():
@@ -116,12 +220,29 @@ class Renderer():
     +Z = up
     """
 
+    __slots__ = ("eye_radius", "eye_position", "eye_target", "eye_up", "eye_closedness",
+                 "iris",
+                 "cornea_refractive_index",
+                 "pupil_radius",
+                 "camera_position", "camera_target", "camera_up",
+                 "image_size", "focal_length", "focus_distance",
+                 "fstop",
+                 "lights",
+                 "render_samples", "render_seed", "render_tile_size", "render_adaptive_sampling", "render_denoiser",
+                 "camera_noise_seed",
+                 "kernel_cache_path",
+                 "_use_worker", "_worker", "_blender_env")
+
     _renderer_active = False
 
     def __enter__(self):
+        # Background renders inside the with block share one blender process
+        self._use_worker = True
         return self
 
     def __exit__(self, type, value, traceback):
+        self._use_worker = False
+        self._stop_worker()
         Renderer._renderer_active = False
 
     def __init__(self):
@@ -154,10 +275,127 @@ class Renderer():
 
         self.render_samples = 20
         self.render_seed = None
+        # None keeps the model's settings
+        self.render_tile_size = None
+        self.render_adaptive_sampling = None
+        # "OPTIX" or "OPENIMAGEDENOISE", lets you get away with fewer render_samples
+        self.render_denoiser = None
 
         self.camera_noise_seed = None
 
-    def render(self, path, params=None, background=True, cuda=True, attempts=5):
+        # Kept across blender runs, so OptiX kernels are only compiled once. Renders use
+        # CUDA rather than OptiX, so this only matters with render_denoiser = "OPTIX".
+        self.kernel_cache_path = os.path.join(_user_cache_dir(), "optix")
+
+        self._use_worker = False
+        self._worker = None
+        self._blender_env = None
+
+    def _env(self):
+        env = dict(self._blender_env or os.environ)
+        if self.kernel_cache_path:
+            os.makedirs(self.kernel_cache_path, mode=0o700, exist_ok=True)
+            # Don't trust compiled kernels from a directory someone else made
+            if hasattr(os, "getuid") and os.stat(self.kernel_cache_path).st_uid != os.getuid():
+                raise RuntimeError("Kernel cache {} is not owned by the current user".format(self.kernel_cache_path))
+            env["OPTIX_CACHE_PATH"] = self.kernel_cache_path
+        return env
+
+    def _stop_worker(self, kill=False):
+        if self._worker is not None:
+            if kill and self._worker.process.poll() is None:
+                _kill_blender(self._worker.process)
+            self._worker.close()
+            self._worker = None
+
+    def render_batch(self, frames, cuda=True, attempts=5, warn_no_lights=True):
+        """Render several frames in a single background blender process.
+
+        Each frame is a dict with the output "path", an optional "params" path,
+        and any renderer attributes (e.g. "eye_target" or "lights") to change
+        for that frame only.
+        """
+        frames = [dict(frame) for frame in frames]
+        for frame in frames:
+            if "path" not in frame:
+                raise RuntimeError("Frame has no output path")
+            for k in frame:
+                if k not in ("path", "params") and (k.startswith("_") or k not in Renderer.__slots__):
+                    raise RuntimeError("Unknown renderer attribute {}".format(k))
+
+        use_worker = self._use_worker
+        self._use_worker = True
+        try:
+            for frame in frames:
+                path = frame.pop("path")
+                params = frame.pop("params", None)
+                saved = {k: getattr(self, k) for k in frame}
+                try:
+                    for k, v in frame.items():
+                        setattr(self, k, v)
+                    self.render(path, params, cuda=cuda, attempts=attempts, warn_no_lights=warn_no_lights)
+                finally:
+                    for k, v in saved.items():
+                        setattr(self, k, v)
+        finally:
+            self._use_worker = use_worker
+            if not use_worker:
+                self._stop_worker()
+
+    def render_many(self, frames, workers, gpus=None, cuda=True, attempts=5):
+        """Render frames in parallel using several background blender processes.
+
+        Frames are given as for render_batch. If gpus is set, each blender
+        process only sees one of that many CUDA devices.
+        """
+        slots = Queue()
+        for i in range(max(workers, 1)):
+            slot = copy.copy(self)
+            slot._use_worker = True
+            slot._worker = None
+            if gpus:
+                slot._blender_env = dict(self._blender_env or os.environ, CUDA_VISIBLE_DEVICES=str(i % gpus))
+            slots.put(slot)
+        renderers = list(slots.queue)
+
+        def render_frame(frame):
+            slot = slots.get()
+            try:
+                slot.render_batch([frame], cuda=cuda, attempts=attempts)
+            finally:
+                slots.put(slot)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(renderers)) as executor:
+                for _ in executor.map(render_frame, frames):
+                    pass
+        finally:
+            for slot in renderers:
+                slot._stop_worker()
+
+    def warm_up(self, cuda=True, attempts=5):
+        """Render a throwaway 1x1 image so blender loads its render kernels.
+
+        Inside a with block this makes the worker ready for the first real
+        frame. Outside of one, it only helps with render_denoiser = "OPTIX",
+        whose compiled kernels are kept in kernel_cache_path.
+        """
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as warm_up_file:
+            pass
+        try:
+            self.render_batch([{
+                "path": warm_up_file.name,
+                "camera_position": [0, -50, 0],
+                "camera_target": [0, 0, 0],
+                "image_size": (1, 1),
+                "render_samples": 1,
+                "lights": [],
+            }], cuda=cuda, attempts=attempts, warn_no_lights=False)
+        finally:
+            if os.path.exists(warm_up_file.name):
+                os.remove(warm_up_file.name)
+
+    def render(self, path, params=None, background=True, cuda=True, attempts=5, warn_no_lights=True):
         __, ext = os.path.splitext(path)
         ext = ext.lower()
         if ext == ".png":
@@ -169,25 +407,38 @@ class Renderer():
         else:
             raise RuntimeError("Path extension needs to be one of png, jpg or bmp")
 
-        new_ireye_path = os.path.join(TEXTURE_PATH, "ireye-{}.png".format(self.iris))
-        if not os.path.exists(new_ireye_path):
-            raise RuntimeError("Eye texture {} does not exist. Create one in the textures folder.".format("ireye-{}.png".format(self.iris)))
-
-        with open(BLENDER_SCRIPT_TEMPLATE) as blender_script_template_file:
-            blender_script_template = blender_script_template_file.read()
-        blender_script_template = blender_script_template.replace("{","{{")
-        blender_script_template = blender_script_template.replace("}","}}")
-        blender_script_template = blender_script_template.replace("$INPUTS","{}")
+        output_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(output_dir):
+            raise RuntimeError("Output directory {} does not exist".format(output_dir))
+
+        if self.render_denoiser and self.render_denoiser.upper() not in ("OPTIX", "OPENIMAGEDENOISE"):
+            raise RuntimeError("Denoiser needs to be one of OPTIX or OPENIMAGEDENOISE")
+
+        global _AVAILABLE_IRISES
+        if self.iris not in _AVAILABLE_IRISES:
+            # Textures may have been added or removed since the last scan, and on
+            # case-insensitive filesystems the name needn't match the file's case
+            _AVAILABLE_IRISES = _find_irises()
+            if (self.iris not in _AVAILABLE_IRISES and
+                    not os.path.exists(os.path.join(TEXTURE_PATH, "ireye-{}.png".format(self.iris)))):
+                raise RuntimeError("Eye texture {} does not exist. Create one in the textures folder, or use one of: {}".format(
+                    "ireye-{}.png".format(self.iris), ", ".join(sorted(_AVAILABLE_IRISES))))
+
+        # Fail before doing any work if blender or the model are missing
+        blender_path = get_blender_path()
+        for required_path in (MODEL_PATH, BLENDER_DRIVER_SCRIPT):
+            if not os.path.exists(required_path):
+                raise RuntimeError("{} does not exist".format(required_path))
 
         if self.camera_position is None:
             raise RuntimeError("Camera position not set")
         if self.camera_target is None:
             raise RuntimeError("Camera target not set")
-        if len(self.lights) == 0:
+        if len(self.lights) == 0 and warn_no_lights:
             print("WARNING: No lights in scene")
 
         if self.focus_distance is None:
-            focus_distance = math.sqrt(sum((a-b)**2 for a,b in zip(self.camera_position, self.camera_target)))
+            focus_distance = math.dist(self.camera_position, self.camera_target)
         else:
             focus_distance = self.focus_distance
 
@@ -203,94 +454,103 @@ class Renderer():
         else:
             camera_noise_seed = self.camera_noise_seed
 
-        try:
-            with tempfile.NamedTemporaryFile("w", suffix=".log", delete=False) as blender_err_file:
-                blender_err_file_name = blender_err_file.name
-
-            inputs = {
-                "input_use_cuda": cuda,
-                "input_eye_radius": self.eye_radius,
-                "input_eye_pos": "Vector({})".format(list(self.eye_position)),
-                "input_eye_target": "Vector({})".format(list(self.eye_target)),
-                "input_eye_up": "Vector({})".format(list(self.eye_up)),
-                "input_eye_closedness": self.eye_closedness,
-
-                "input_iris": "'{}'".format(self.iris),
-
-                "input_eye_cornea_refrative_index": self.cornea_refractive_index,
-
-                "input_pupil_radius": self.pupil_radius,
-
-                "input_cam_pos": "Vector({})".format(list(self.camera_position)),
-                "input_cam_target": "Vector({})".format(list(self.camera_target)),
-                "input_cam_up": "Vector({})".format(list(self.camera_up)),
-
-                "input_cam_image_size": list(self.image_size),
-                "input_cam_focal_length": self.focal_length,
-                "input_cam_focus_distance": focus_distance,
-                "input_cam_fstop": self.fstop,
-
-                "input_lights": ["Light({})".format(
-                        ",".join("{}={}".format(k,v) for k,v in
-                            {
-                                "location": "Vector({})".format(list(l.location)),
-                                "target": "Vector({})".format(list(l.target)),
-                                "type": '"{}"'.format(l.type),
-                                "size": l.size,
-                                "strength": l.strength,
-                                "view_angle": l.view_angle
-                            }.items())) for l in self.lights],
-
-                "input_render_samples" : self.render_samples,
-                "input_render_seed" : render_seed,
-                "input_camera_noise_seed" : camera_noise_seed,
-                "output_render_path" : "'{}'".format(path).replace("\\","/"),
-            }
-            if params:
-                inputs["output_params_path"] = "'{}'".format(params).replace("\\","/")
-            else:
-                inputs["output_params_path"] = "None"
-
-            def inputVal(v):
-                if isinstance(v,list):
-                    return '[{}]'.format(",".join(inputVal(x) for x in v))
-                else:
-                    return str(v)
-
-            blender_script = blender_script_template.format("\n".join(
-                                "{} = {}".format(k,inputVal(v)) for k,v in inputs.items()))
-            blender_script = "\n".join("    " + x for x in blender_script.split("\n"))
-            blender_script = ("import sys\ntry:\n" + blender_script +
-                "\nexcept:"
-                "\n    import traceback"
-                "\n    with open(r'" + blender_err_file.name + "','a') as f:"
-                "\n        f.write('\\n'.join(traceback.format_exception(*sys.exc_info())))"
-                "\n    sys.exit(1)")
-
-            with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as blender_script_file:
-                blender_script_file.write(blender_script)
+        # Convert explicitly, so numpy scalars and arrays serialise to JSON
+        def vec(v):
+            return [float(x) for x in v]
+
+        inputs = {
+            "input_use_cuda": bool(cuda),
+            "input_eye_radius": float(self.eye_radius),
+            "input_eye_pos": vec(self.eye_position),
+            "input_eye_target": vec(self.eye_target),
+            "input_eye_up": vec(self.eye_up),
+            "input_eye_closedness": float(self.eye_closedness),
+
+            "input_iris": str(self.iris),
+
+            "input_eye_cornea_refrative_index": float(self.cornea_refractive_index),
+
+            "input_pupil_radius": float(self.pupil_radius),
+
+            "input_cam_pos": vec(self.camera_position),
+            "input_cam_target": vec(self.camera_target),
+            "input_cam_up": vec(self.camera_up),
+
+            "input_cam_image_size": [int(x) for x in self.image_size],
+            "input_cam_focal_length": float(self.focal_length),
+            "input_cam_focus_distance": float(focus_distance),
+            "input_cam_fstop": float(self.fstop),
+
+            "input_lights": [{
+                    "location": vec(l.location),
+                    "target": vec(l.target),
+                    "type": str(l.type),
+                    "size": float(l.size),
+                    "strength": float(l.strength),
+                    "view_angle": float(l.view_angle)
+                } for l in self.lights],
+
+            "input_render_samples" : int(self.render_samples),
+            "input_render_tile_size" : int(self.render_tile_size) if self.render_tile_size is not None else None,
+            "input_render_adaptive_sampling" : bool(self.render_adaptive_sampling) if self.render_adaptive_sampling is not None else None,
+            "input_render_denoiser" : self.render_denoiser.upper() if self.render_denoiser else None,
+            "input_render_seed" : int(render_seed),
+            "input_camera_noise_seed" : int(camera_noise_seed),
+            "output_render_path" : path.replace("\\","/"),
+            "output_params_path" : params.replace("\\","/") if params else None,
+        }
+
+        blender_inputs = json.dumps(inputs, indent=4)
+
+        # The log and inputs live in here, and are cleaned up with it
+        with tempfile.TemporaryDirectory(prefix="eyemodel-") as temp_dir:
+            blender_err_file_name = os.path.join(temp_dir, "blender.log")
+            blender_inputs_file_name = os.path.join(temp_dir, "inputs.json")
+
+            with open(blender_err_file_name, "w"):
+                pass
+
+            # The render goes next to the output instead, so it can be renamed into place
+            # without copying. If we're killed, this is the one file left behind.
+            blender_outfile_fd, blender_outfile_name = tempfile.mkstemp(prefix=".eyemodel-", suffix="0000", dir=output_dir)
+            os.close(blender_outfile_fd)
 
             try:
-                with tempfile.NamedTemporaryFile(suffix="0000", delete=False) as blender_outfile:
-                    pass
-
-                blender_args = [get_blender_path(),
-                                MODEL_PATH,                              # Load model
-                                "--enable-autoexec",                     # Automatic python script execution
-                                "--verbose", "0",                        # No debug output
-                                "--python", blender_script_file.name,    # Run the temporary blender script file
-                                "-o", blender_outfile.name[:-4]+"####",  # Render output to temporary file
-                                "--render-format", render_format,        # Set render format (e.g. Jpeg) 
-                                "-noaudio",                              # Don't use audio
-                                "--use-extension", "0",]                 # Don't append the file extension
-                if background:
-                    blender_args += ["--background"]                     # Load the file in the background (no UI)
-                    if self.render_samples > 0:
-                        blender_args += ["--render-frame", "0"]          # Render frame 0
+                with open(blender_inputs_file_name, "w") as blender_inputs_file:
+                    blender_inputs_file.write(blender_inputs)
+
+                use_worker = background and self._use_worker
+                if use_worker:
+                    command = {
+                        "script": BLENDER_DRIVER_SCRIPT,
+                        "inputs": blender_inputs_file_name,
+                        "output": blender_outfile_name[:-4]+"####",  # Render output to temporary file
+                        "format": render_format,
+                        "render": self.render_samples > 0,
+                        "log": blender_err_file_name,
+                    }
+                else:
+                    blender_args = [blender_path,
+                                    MODEL_PATH,                              # Load model
+                                    "--enable-autoexec",                     # Automatic python script execution
+                                    "--verbose", "0",                        # No debug output
+                                    "--python-exit-code", "1",               # Fail if the script raises an exception
+                                    "--python", BLENDER_DRIVER_SCRIPT,       # Run the blender script
+                                    "-o", blender_outfile_name[:-4]+"####",  # Render output to temporary file
+                                    "--render-format", render_format,        # Set render format (e.g. Jpeg) 
+                                    "-noaudio",                              # Don't use audio
+                                    "--use-extension", "0",]                 # Don't append the file extension
+                    if background:
+                        blender_args += ["--background"]                     # Load the file in the background (no UI)
+                        if self.render_samples > 0:
+                            blender_args += ["--render-frame", "0"]          # Render frame 0
+                    blender_args += ["--", blender_inputs_file_name]         # Inputs for the blender script (must be last)
 
                 # Write script to error log
                 with open(blender_err_file_name, "a") as blender_err_file:
-                    if sys.platform == 'win32':
+                    if use_worker:
+                        blender_err_file.write("worker command: {}".format(json.dumps(command)))
+                    elif sys.platform == 'win32':
                         blender_err_file.write(subprocess.list2cmdline(blender_args))
                     else:
                         blender_err_file.write(" ".join('"{}"'.format(arg) if " " in arg else arg
@@ -298,73 +558,55 @@ class Renderer():
 
                     blender_err_file.write("\n\n")
                     
-                    blender_err_file.write("{0}:\n".format(blender_script_file.name))
+                    blender_err_file.write("{0}:\n".format(blender_inputs_file_name))
                     blender_err_file.write("------\n")
                     blender_err_file.write("\n".join(
                         "{: 4} | {}".format(i+1,x)
-                        for i,x in enumerate(blender_script.split("\n"))))
+                        for i,x in enumerate(blender_inputs.split("\n"))))
                     blender_err_file.write("\n------\n")
 
                 attempts = max(attempts,1)
                 for attempt in range(1, 1 + attempts):
+                    p = None
+                    done = False
                     try:
-                        def enqueue_output(out, queue, name):
-                            for line in iter(out.readline, b''):
-                                line = line.rstrip()
-                                if sys.version_info.major >= 3:
-                                    line = line.decode("utf-8")
-                                queue.put((name, line))
-                            out.close()
-
-                        if hasattr(os.sys, 'winver'):
-                            p = subprocess.Popen(blender_args, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+                        if use_worker:
+                            if self._worker is None:
+                                self._worker = _BlenderWorker(blender_path, self._env())
+                            p = self._worker.process
+
+                            print("Sending scene to blender")
+                            self._worker.send(command)
+                            status = _process_output(self._worker.lines, blender_err_file_name, WORKER_SENTINEL)
+                            if status is None:
+                                print("Blender worker quit unexpectedly")
+                                raise subprocess.CalledProcessError(p.wait(), self._worker.args)
+                            if status != 0:
+                                print("Blender error")
+                                raise subprocess.CalledProcessError(status, self._worker.args)
+
+                            print("Blender finished")
                         else:
-                            p = subprocess.Popen(blender_args, bufsize=0, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                            with open(blender_err_file_name, "a") as blender_err_file:
+                                p = _start_blender(blender_args, blender_err_file, env=self._env())
 
-                        q = Queue()
-                        tout = threading.Thread(target=enqueue_output, args=(p.stdout, q, "out"))
-                        tout.daemon = True  # thread dies with the program
-                        terr = threading.Thread(target=enqueue_output, args=(p.stderr, q, "err"))
-                        terr.daemon = True  # thread dies with the program
-                        tout.start()
-                        terr.start()
+                            print("Starting blender")
 
-                        print("Starting blender")
+                            _process_output(_read_lines(p), blender_err_file_name)
 
-                        # while tout.isAlive() or terr.isAlive(): # deprecated in python 3.9
-                        while tout.is_alive() or terr.is_alive():
-                            try:
-                                line = q.get(timeout=0.1)
-                            except Empty:
-                                pass
-                            else:
-                                if line[0] == "out":
-                                    m = RENDER_LINE_RE.match(line[1])
-                                    if m:
-                                        tile = int(m.group("tile"))
-                                        tiles = int(m.group("tiles"))
-                                        sample = int(m.group("sample"))
-                                        samples = int(m.group("samples"))
-                                        print("Rendered {percent}%, time remaining: {rem} (tile {tile}/{tiles}, sample {sample}/{samples})".format(
-                                            percent=100 * ((tile-1)*samples + (sample-1)) / (tiles*samples),
-                                            **m.groupdict()
-                                        ))
-                                
-                                with open(blender_err_file_name, "a") as blender_err_file:
-                                    blender_err_file.write(line[0])
-                                    blender_err_file.write(" | ")
-                                    blender_err_file.write(line[1])
-                                    blender_err_file.write("\n")
-                        
-                        if p.wait() != 0:
-                            print("Blender error")
-                            raise subprocess.CalledProcessError(p.returncode, blender_args)
-
-                        print("Blender quit")
+                            if p.wait() != 0:
+                                print("Blender error")
+                                raise subprocess.CalledProcessError(p.returncode, blender_args)
+
+                            print("Blender quit")
+                        done = True
                         break
 
                     except KeyboardInterrupt:
                         raise
+                    except (FileNotFoundError, PermissionError):
+                        # Blender can't be run at all, retrying won't help
+                        raise
                     except:
                         # Sometimes blender fails in rendering, so retry until success
                         traceback.print_exc()
@@ -382,19 +624,21 @@ class Renderer():
                             print("Blender call failed")
                             raise
                     finally:
-                        if p.poll() is None:
-                            print("Killing blender")
-                            if hasattr(os.sys, 'winver'):
-                                os.kill(p.pid, signal.CTRL_BREAK_EVENT)
-                            else:
-                                p.send_signal(signal.SIGKILL)
-                            p.wait()
-                            print("Blender killed")
+                        if use_worker:
+                            # The scene may be left half set up, so start afresh on failure
+                            if not done:
+                                self._stop_worker(kill=True)
+                        elif p is not None and p.poll() is None:
+                            _kill_blender(p)
 
                 if background and self.render_samples > 0:
-                    if os.path.exists(path):
-                        os.remove(path)
-                    shutil.move(blender_outfile.name, path)
+                    try:
+                        os.replace(blender_outfile_name, path)
+                    except OSError as e:
+                        # Output path is itself a mount point, so fall back to copying
+                        if e.errno != errno.EXDEV:
+                            raise
+                        shutil.move(blender_outfile_name, path)
                     print(("Moved image to {}".format(path)))
 
             except:
@@ -404,10 +648,8 @@ class Renderer():
                 raise
 
             finally:
-                if os.path.exists(blender_outfile.name):
-                    os.remove(blender_outfile.name)
-        finally:
-            # Sleep for a short time to let file handles get free'd
-            time.sleep(0.1)
-            os.remove(blender_err_file.name)
-            os.remove(blender_script_file.name)
+                if sys.platform == 'win32':
+                    # Sleep for a short time to let file handles get free'd
+                    time.sleep(0.1)
+                if os.path.exists(blender_outfile_name):
+                    os.remove(blender_outfile_name)
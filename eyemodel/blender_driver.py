@@ -8,6 +8,7 @@ import sys
 import functools
 import collections
 import random
+import json
 from mathutils import Vector, Matrix
 try:
     import numpy as np
@@ -16,7 +17,18 @@ except:
 
 Light = collections.namedtuple("Light", ["location", "target", "type", "size", "strength", "view_angle"])
 
-$INPUTS
+# The inputs for each render are generated into a small json file, whose path is
+# passed after "--" (or set directly by the worker)
+if "inputs_path" not in globals():
+    inputs_path = sys.argv[sys.argv.index("--") + 1]
+with open(inputs_path) as inputs_file:
+    inputs = json.load(inputs_file)
+for k in ["input_eye_pos", "input_eye_target", "input_eye_up",
+          "input_cam_pos", "input_cam_target", "input_cam_up"]:
+    inputs[k] = Vector(inputs[k])
+inputs["input_lights"] = [Light(**dict(l, location=Vector(l["location"]), target=Vector(l["target"])))
+                          for l in inputs["input_lights"]]
+globals().update(inputs)
 
 scene = bpy.context.scene
 armature = bpy.data.objects['Armature Head']
@@ -131,10 +143,14 @@ else:
 
 for obj in list(bpy.data.objects):
     if obj.type == 'LIGHT':
+        lamp_data = obj.data
         # Ensure the object is in the collection
         if obj.name in scene.collection.objects:
             scene.collection.objects.unlink(obj)
         bpy.data.objects.remove(obj)
+        # Remove the datablock too, so a long-lived worker doesn't pile up orphaned lights
+        if lamp_data.users == 0:
+            bpy.data.lights.remove(lamp_data)
 
 # Add lights
 for i, light in enumerate(input_lights):
@@ -254,6 +270,14 @@ camera.dof.focus_distance = input_to_world(input_cam_focus_distance)
 scene.cycles.aperture_fstop = input_cam_fstop
 scene.cycles.samples = input_render_samples
 scene.cycles.seed = input_render_seed % 2147483647  # Max int value for seed
+if input_render_tile_size is not None:
+    scene.cycles.use_auto_tile = True
+    scene.cycles.tile_size = input_render_tile_size
+if input_render_adaptive_sampling is not None:
+    scene.cycles.use_adaptive_sampling = input_render_adaptive_sampling
+if input_render_denoiser:
+    scene.cycles.use_denoising = True
+    scene.cycles.denoiser = input_render_denoiser
 
 cam_rand = random.Random()
 cam_rand.seed(input_camera_noise_seed)
@@ -425,4 +449,3 @@ if output_params_path:
         #params_file.write("camera focus distance = {}\n".format(input_cam_focus_distance))
         #params_file.write("camera fstop = {}\n".format(input_cam_fstop))
         #params_file.write("image size = {}\n".format(tuple(input_cam_image_size)))
-# vim: ft=python
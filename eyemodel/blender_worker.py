@@ -0,0 +1,55 @@
+# DO NOT TRY TO RUN THIS FILE, IT ONLY RUNS IN BLENDER
+#
+# Persistent render worker. Reads one JSON command per line from stdin, runs the
+# driver script on the generated inputs it names, optionally renders the scene,
+# and then prints the sentinel (passed after "--") followed by an exit status, so
+# that the caller knows the command has finished. While a command runs, stderr is
+# sent to the log file it names. Exits when stdin is closed.
+
+import bpy
+import os
+import sys
+import json
+import traceback
+
+sentinel = sys.argv[sys.argv.index("--") + 1]
+
+# The driver script doesn't change between commands, so only compile it once
+scripts = {}
+
+stderr_fd = os.dup(2)
+
+# The driver leaves optional render settings alone when they're None, so put the
+# model's values back before each command, otherwise they'd leak between frames
+model_cycles_settings = {k: getattr(bpy.context.scene.cycles, k) for k in
+                         ["use_denoising", "denoiser", "use_auto_tile", "tile_size", "use_adaptive_sampling"]}
+
+for line in iter(sys.stdin.readline, ""):
+    command = json.loads(line)
+    status = 0
+    sys.stderr.flush()
+    with open(command["log"], "a") as log_file:
+        os.dup2(log_file.fileno(), 2)
+    try:
+        for k, v in model_cycles_settings.items():
+            setattr(bpy.context.scene.cycles, k, v)
+
+        if command["script"] not in scripts:
+            with open(command["script"]) as script_file:
+                scripts[command["script"]] = compile(script_file.read(), command["script"], "exec")
+        exec(scripts[command["script"]], {"__name__": "__main__", "inputs_path": command["inputs"]})
+
+        if command["render"]:
+            scene = bpy.context.scene
+            scene.render.filepath = command["output"]
+            scene.render.image_settings.file_format = command["format"]
+            scene.render.use_file_extension = False
+            bpy.ops.render.render(write_still=True)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+
+    sys.stderr.flush()
+    os.dup2(stderr_fd, 2)
+    sys.stdout.write("{} {}\n".format(sentinel, status))
+    sys.stdout.flush()